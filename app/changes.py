@@ -0,0 +1,97 @@
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+
+CHANGE_RETENTION_DAYS = int(os.environ.get("CHANGE_RETENTION_DAYS", "7"))
+# How long a missing sequence number may stay open before readers treat the writer as failed and move past it
+CHANGE_GAP_GRACE_SECONDS = float(os.environ.get("CHANGE_GAP_GRACE_SECONDS", "5"))
+CHANGE_PURGE_INTERVAL_SECONDS = 600
+SEQUENCE_ID = "user_changes"
+EXPIRED_SEQUENCE_ID = "user_changes_expired"
+
+
+def ensure_change_indexes(changes):
+    changes.create_index("seq", unique=True)
+    # Records are purged by `expire_changes`, which records what it removed; a TTL index would not
+    if changes.index_information().get("ts_1", {}).get("expireAfterSeconds") is not None:
+        changes.drop_index("ts_1")
+    changes.create_index("ts")
+
+
+def next_sequence(counters) -> int:
+    counter = counters.find_one_and_update(
+        {"_id": SEQUENCE_ID},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter["seq"]
+
+
+def record_change(changes, counters, op: str, user_id: str, fields: Optional[dict] = None) -> int:
+    """
+    Append a change record. `fields` holds the whole profile for `create`, only the
+    changed fields for `update` (None for a removed field) and nothing for `delete`.
+    """
+    seq = next_sequence(counters)
+    changes.insert_one({
+        "seq": seq,
+        "op": op,
+        "user_id": user_id,
+        "fields": fields,
+        "ts": datetime.utcnow(),
+    })
+    return seq
+
+
+def current_sequence(counters) -> int:
+    counter = counters.find_one({"_id": SEQUENCE_ID})
+    return counter["seq"] if counter is not None else 0
+
+
+def expired_sequence(counters) -> int:
+    counter = counters.find_one({"_id": EXPIRED_SEQUENCE_ID})
+    return counter["seq"] if counter is not None else 0
+
+
+def expire_changes(changes, counters):
+    """
+    Delete records older than CHANGE_RETENTION_DAYS. The highest deleted sequence is
+    saved first, so a missing number is only reported as expired if it really was.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=CHANGE_RETENTION_DAYS)
+    newest_expired = changes.find_one({"ts": {"$lt": cutoff}}, {"seq": 1}, sort=[("seq", DESCENDING)])
+    if newest_expired is None:
+        return
+    counters.update_one({"_id": EXPIRED_SEQUENCE_ID}, {"$max": {"seq": newest_expired["seq"]}}, upsert=True)
+    changes.delete_many({"seq": {"$lte": newest_expired["seq"]}})
+
+
+def history_truncated(counters, since: int) -> bool:
+    """True when records after `since` already expired, so the consumer has to sync from scratch."""
+    return since < expired_sequence(counters)
+
+
+def read_changes(changes, since: int, limit: int) -> Tuple[List[dict], bool]:
+    """
+    Return up to `limit` committed records after `since` and whether more are committed.
+
+    A sequence number is taken before its record is inserted, so with several writers
+    N + 1 can land before N. Reading stops at such a gap, otherwise a consumer would move
+    past N and never see it. A gap older than CHANGE_GAP_GRACE_SECONDS belongs to a write
+    that failed after taking its number and is skipped.
+    """
+    grace_start = datetime.utcnow() - timedelta(seconds=CHANGE_GAP_GRACE_SECONDS)
+    records = changes.find({"seq": {"$gt": since}}, {"_id": 0}).sort("seq", ASCENDING).limit(limit + 1)
+
+    committed, expected = [], since + 1
+    for record in records:
+        if record["seq"] != expected and record["ts"] > grace_start:
+            return committed, False
+        if len(committed) == limit:
+            return committed, True
+        committed.append(record)
+        expected = record["seq"] + 1
+    return committed, False
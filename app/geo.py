@@ -0,0 +1,127 @@
+import argparse
+import base64
+import csv
+import json
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import certifi
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gazetteer.csv")
+GEO_FIELD = "geo"
+
+
+def normalize_location(location: str) -> str:
+    parts = [part.strip().lower() for part in location.split(",")]
+    return ", ".join(part for part in parts if part)
+
+
+def geo_point(longitude: float, latitude: float) -> dict:
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+
+@lru_cache(maxsize=1)
+def load_gazetteer(path: str = GAZETTEER_PATH) -> Dict[str, dict]:
+    """
+    Map normalized location strings ("new york, ny") to GeoJSON points.
+    A bare city name is also accepted when only one entry carries it.
+    """
+    gazetteer = {}
+    cities: Dict[str, List[dict]] = {}
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            point = geo_point(float(row["longitude"]), float(row["latitude"]))
+            key = normalize_location(row["location"])
+            gazetteer[key] = point
+            cities.setdefault(key.split(", ")[0], []).append(point)
+
+    for city, points in cities.items():
+        if len(points) == 1:
+            gazetteer.setdefault(city, points[0])
+    return gazetteer
+
+
+def resolve_location(location: Optional[str]) -> Optional[dict]:
+    if not location:
+        return None
+    return load_gazetteer().get(normalize_location(location))
+
+
+def encode_cursor(distance: float, user_id: str) -> str:
+    payload = json.dumps({"d": distance, "id": user_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Raises ValueError when the cursor was not produced by `encode_cursor`."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {"d": float(payload["d"]), "id": ObjectId(payload["id"])}
+    except Exception as error:
+        raise ValueError("Invalid cursor") from error
+
+
+def nearby_pipeline(point: dict, radius_m: float, limit: int, query: dict, cursor: Optional[dict] = None):
+    """
+    A single `$geoNear` query ordered by (distance, _id). Users in the same city share
+    one gazetteer point, so ties are common: pages continue after the last
+    (distance, _id) pair rather than after the last distance.
+
+    The `$sort` on (distance, _id) has to see every user that matches inside the
+    radius beyond the cursor, so a page costs O(users in the radius), not O(limit).
+    """
+    near = {
+        "near": point,
+        "key": GEO_FIELD,
+        "distanceField": "distance",
+        "maxDistance": radius_m,
+        "spherical": True,
+        "query": query,
+    }
+    pipeline = [{"$geoNear": near}]
+    if cursor is not None:
+        near["minDistance"] = cursor["d"]
+        pipeline.append({"$match": {"$or": [
+            {"distance": {"$gt": cursor["d"]}},
+            {"distance": cursor["d"], "_id": {"$gt": cursor["id"]}},
+        ]}})
+    return pipeline + [{"$sort": {"distance": 1, "_id": 1}}, {"$limit": limit}]
+
+
+def next_cursor(users: List[dict], limit: int) -> Optional[str]:
+    if len(users) < limit:
+        return None
+    return encode_cursor(users[-1]["distance"], str(users[-1]["_id"]))
+
+
+def backfill_coordinates(collection, dry_run: bool = False, batch_size: int = 500):
+    """Store gazetteer coordinates on users that have a location but no coordinates yet."""
+    resolved, unresolved, batch = 0, set(), []
+    for user in collection.find({GEO_FIELD: {"$exists": False}}, {"location": 1}):
+        point = resolve_location(user.get("location"))
+        if point is None:
+            unresolved.add(user.get("location"))
+            continue
+        resolved += 1
+        batch.append(UpdateOne({"_id": user["_id"]}, {"$set": {GEO_FIELD: point}}))
+        if len(batch) >= batch_size and not dry_run:
+            collection.bulk_write(batch, ordered=False)
+            batch = []
+    if batch and not dry_run:
+        collection.bulk_write(batch, ordered=False)
+    return resolved, unresolved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Resolve user locations to coordinates from the bundled gazetteer")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be resolved without writing")
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ.get('ATLAS_URI'), tlsCAFile=certifi.where())
+    resolved_count, unresolved_locations = backfill_coordinates(client["TeamUp"]["Users"], dry_run=args.dry_run)
+    print(f"Resolved {resolved_count} users")
+    if unresolved_locations:
+        print("Unresolved locations:", sorted(str(location) for location in unresolved_locations))
@@ -1,9 +1,9 @@
 import datetime
 import os
+from functools import lru_cache
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import RedirectResponse
-from fastapi_sso.sso.google import GoogleSSO
 from jose import jwt
 from starlette.middleware.cors import CORSMiddleware
 
@@ -12,9 +12,18 @@ CLIENT_ID = os.environ.get('CLIENT_ID')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
 AWS_EC2_ADDRESS = os.environ.get('AWS_EC2_ADDRESS')
 
-sso = GoogleSSO(client_id=CLIENT_ID,
-                client_secret=CLIENT_SECRET,
-                redirect_uri=AWS_EC2_ADDRESS+"/auth/callback")
+
+@lru_cache(maxsize=1)
+def get_sso():
+    if not AWS_EC2_ADDRESS:
+        raise HTTPException(status_code=503, detail="Google SSO is not configured")
+
+    from fastapi_sso.sso.google import GoogleSSO
+
+    return GoogleSSO(client_id=CLIENT_ID,
+                     client_secret=CLIENT_SECRET,
+                     redirect_uri=AWS_EC2_ADDRESS + "/auth/callback")
+
 
 google_auth_app = FastAPI()
 google_auth_app.add_middleware(
@@ -28,6 +37,7 @@ google_auth_app.add_middleware(
 
 @google_auth_app.get("/login")
 async def login():
+    sso = get_sso()
     with sso:
         return await sso.get_login_redirect()
 
@@ -41,6 +51,7 @@ async def logout():
 
 @google_auth_app.get("/callback")
 async def login_callback(request: Request):
+    sso = get_sso()
     with sso:
         openid = await sso.verify_and_process(request)
         if not openid:
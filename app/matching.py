@@ -0,0 +1,196 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+WORD_BITS = 64
+MATCH_METHODS = ("jaccard", "weighted")
+SAMPLE_STRIDE = 64
+
+
+def normalize_interest(interest: str) -> str:
+    return interest.strip().lower()
+
+
+class InterestIndex:
+    """
+    In-memory index of user interests used to rank users by interest overlap.
+
+    Every user is a row of a packed bitset over the interest vocabulary, so a
+    query only touches one column per interest of the requesting user. Rows are
+    kept dense: removing a user moves the last row into the freed slot.
+
+    The index lives in the worker process. It is built from Mongo at startup,
+    updated by the write endpoints of the same worker and refreshed from the
+    change feed for writes handled elsewhere.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.clear(capacity)
+
+    def clear(self, capacity: int = 1024):
+        self._vocab: Dict[str, int] = {}
+        self._location_codes: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._bits = np.zeros((capacity, 1), dtype=np.uint64)
+        self._counts = np.zeros(capacity, dtype=np.int32)
+        self._locations = np.full(capacity, -1, dtype=np.int32)
+        self._df = np.zeros(WORD_BITS, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._rows
+
+    def _interest_bit(self, interest: str) -> int:
+        bit = self._vocab.get(interest)
+        if bit is None:
+            bit = len(self._vocab)
+            self._vocab[interest] = bit
+            if bit >= self._bits.shape[1] * WORD_BITS:
+                extra_word = np.zeros((self._bits.shape[0], 1), dtype=np.uint64)
+                self._bits = np.hstack([self._bits, extra_word])
+                self._df = np.concatenate([self._df, np.zeros(WORD_BITS, dtype=np.int64)])
+        return bit
+
+    def _location_code(self, location: Optional[str]) -> int:
+        if not location:
+            return -1
+        return self._location_codes.setdefault(location.strip(), len(self._location_codes))
+
+    def _encode(self, interests: Iterable[str]) -> List[int]:
+        keys = {normalize_interest(interest) for interest in interests or []}
+        return sorted(self._interest_bit(key) for key in keys if key)
+
+    def _row_bits(self, row: int) -> np.ndarray:
+        return np.flatnonzero(np.unpackbits(self._bits[row].view(np.uint8), bitorder="little"))
+
+    def _ensure_capacity(self, size: int):
+        capacity = self._bits.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        grow = capacity - self._bits.shape[0]
+        self._bits = np.vstack([self._bits, np.zeros((grow, self._bits.shape[1]), dtype=np.uint64)])
+        self._counts = np.concatenate([self._counts, np.zeros(grow, dtype=np.int32)])
+        self._locations = np.concatenate([self._locations, np.full(grow, -1, dtype=np.int32)])
+
+    def upsert(self, user_id: str, interests: Iterable[str], location: Optional[str] = None):
+        bits = self._encode(interests)
+        row = self._rows.get(user_id)
+        if row is None:
+            row = len(self._ids)
+            self._ensure_capacity(row + 1)
+            self._ids.append(user_id)
+            self._rows[user_id] = row
+        else:
+            self._df[self._row_bits(row)] -= 1
+
+        self._bits[row] = 0
+        for bit in bits:
+            self._bits[row, bit // WORD_BITS] |= np.uint64(1) << np.uint64(bit % WORD_BITS)
+        self._counts[row] = len(bits)
+        self._locations[row] = self._location_code(location)
+        self._df[bits] += 1
+
+    def remove(self, user_id: str):
+        row = self._rows.pop(user_id, None)
+        if row is None:
+            return
+        self._df[self._row_bits(row)] -= 1
+
+        last = len(self._ids) - 1
+        if row != last:
+            moved_id = self._ids[last]
+            self._bits[row] = self._bits[last]
+            self._counts[row] = self._counts[last]
+            self._locations[row] = self._locations[last]
+            self._ids[row] = moved_id
+            self._rows[moved_id] = row
+        self._ids.pop()
+        self._bits[last] = 0
+        self._counts[last] = 0
+        self._locations[last] = -1
+
+    def rebuild(self, users: Iterable[dict]):
+        """Replace the index content with the given user documents in one vectorized pass."""
+        self.clear()
+        rows, bit_positions, locations = [], [], []
+        for user in users:
+            row = len(self._ids)
+            self._ids.append(str(user["_id"]))
+            self._rows[self._ids[row]] = row
+            bits = self._encode(user.get("interests"))
+            rows.extend([row] * len(bits))
+            bit_positions.extend(bits)
+            locations.append(self._location_code(user.get("location")))
+
+        size = len(self._ids)
+        self._ensure_capacity(max(size, 1))
+        if size == 0:
+            return
+        rows = np.asarray(rows, dtype=np.int64)
+        bit_positions = np.asarray(bit_positions, dtype=np.int64)
+        values = np.left_shift(np.uint64(1), (bit_positions % WORD_BITS).astype(np.uint64))
+        np.bitwise_or.at(self._bits, (rows, bit_positions // WORD_BITS), values)
+        self._counts[:size] = np.bincount(rows, minlength=size)
+        self._locations[:size] = locations
+        self._df[:] = np.bincount(bit_positions, minlength=self._df.shape[0])
+
+    def _has_bit(self, bit: int) -> np.ndarray:
+        column = self._bits[:len(self._ids), bit // WORD_BITS]
+        return (column & (np.uint64(1) << np.uint64(bit % WORD_BITS))) != 0
+
+    @staticmethod
+    def _top_k_floor(scores: np.ndarray, k: int) -> float:
+        # The k-th best score of a strided sample is a lower bound for the k-th
+        # best score overall, so filtering on it keeps every top-k candidate
+        # while the full array is never partitioned.
+        sample = scores[::SAMPLE_STRIDE]
+        floor = np.partition(sample, len(sample) - k)[len(sample) - k] if len(sample) > k else 0
+        return max(float(floor), np.finfo(np.float32).tiny)
+
+    def top_matches(self, user_id: str, k: int = 10, method: str = "jaccard",
+                    same_location: bool = False) -> List[Tuple[str, float]]:
+        """
+        Rank other users by interest overlap with `user_id`.
+
+        `jaccard` scores |A ∩ B| / |A ∪ B|. `weighted` scores the share of the
+        user's interest weight found in the candidate, where rarer interests
+        weigh more (smoothed inverse document frequency).
+        """
+        if method not in MATCH_METHODS:
+            raise ValueError(f"Unknown match method {method}")
+        row = self._rows[user_id]
+        size = len(self._ids)
+        query_bits = self._row_bits(row)
+        if k <= 0 or len(query_bits) == 0:
+            return []
+
+        if method == "jaccard":
+            shared = np.zeros(size, dtype=np.int32)
+            for bit in query_bits:
+                shared += self._has_bit(bit)
+            union = self._counts[:size] + len(query_bits) - shared
+            scores = shared.astype(np.float32) / np.maximum(union, 1)
+        else:
+            weights = (np.log((size + 1) / (self._df[query_bits] + 1)) + 1.0).astype(np.float32)
+            scores = np.zeros(size, dtype=np.float32)
+            for bit, weight in zip(query_bits, weights):
+                scores += self._has_bit(bit) * weight
+            scores /= weights.sum()
+
+        scores[row] = 0
+        if same_location:
+            location = self._locations[row]
+            if location < 0:
+                return []
+            scores[self._locations[:size] != location] = 0
+
+        candidates = np.flatnonzero(scores >= self._top_k_floor(scores, k))
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(self._ids[candidate], float(scores[candidate])) for candidate in candidates]
@@ -0,0 +1,187 @@
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from app.api_auth import validate_api_key
+
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "1"))
+PROFILE_BUFFER_SIZE = int(os.environ.get("PROFILE_BUFFER_SIZE", "50"))
+PROFILE_HEADER = b"x-profile-key"
+
+if PROFILING_ENABLED and PROFILE_INTERVAL_MS <= 0:
+    raise ValueError("PROFILE_INTERVAL_MS must be positive")
+
+# The innermost frame that matches decides where a sample's time goes
+CATEGORIES = (
+    ("mongo", ("/pymongo/", "/bson/")),
+    ("bcrypt", ("/passlib/", "/bcrypt/")),
+    ("pydantic", ("/pydantic/", "/pydantic_core/")),
+    ("lambda", ("/boto3/", "/botocore/")),
+)
+
+
+class ProfileSummary(BaseModel):
+    id: str
+    method: str
+    path: str
+    status_code: Optional[int]
+    started_at: datetime
+    duration_ms: float
+    samples: int
+    time_ms: Dict[str, float]
+
+
+class Profile:
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.status_code = None
+        self.started_at = datetime.now(tz=timezone.utc)
+        self.duration_ms = 0.0
+        self.samples = 0
+        self.stacks = Counter()
+        self.category_us = Counter()
+
+    def summary(self) -> ProfileSummary:
+        time_ms = {category: round(us / 1000, 3) for category, us in self.category_us.items()}
+        return ProfileSummary(id=self.id, method=self.method, path=self.path, status_code=self.status_code,
+                              started_at=self.started_at, duration_ms=round(self.duration_ms, 3),
+                              samples=self.samples, time_ms=time_ms)
+
+    def collapsed(self) -> str:
+        """Folded stacks ("outer;inner microseconds"), readable by flamegraph.pl and speedscope."""
+        return "".join(f"{stack} {us}\n" for stack, us in self.stacks.most_common())
+
+
+class ProfileStore:
+    """Ring buffer holding the most recent profiles of this worker process."""
+
+    def __init__(self, size: int = PROFILE_BUFFER_SIZE):
+        self._profiles = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, profile: Profile):
+        with self._lock:
+            self._profiles.append(profile)
+
+    def list(self) -> List[Profile]:
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        with self._lock:
+            return next((profile for profile in self._profiles if profile.id == profile_id), None)
+
+
+def _categorize(frame) -> str:
+    while frame is not None:
+        filename = frame.f_code.co_filename.replace("\\", "/")
+        for category, markers in CATEGORIES:
+            if any(marker in filename for marker in markers):
+                return category
+        frame = frame.f_back
+    return "other"
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of one thread at a fixed interval. Each sample is weighted by the
+    time elapsed since the previous one, so a late wake-up does not skew the split.
+    """
+
+    def __init__(self, thread_id: int, profile: Profile, interval: float):
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._profile = profile
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._stopped.wait(self._interval):
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                elapsed_us = int((now - last) * 1_000_000)
+                self._profile.samples += 1
+                self._profile.stacks[_collapse(frame)] += elapsed_us
+                self._profile.category_us[_categorize(frame)] += elapsed_us
+            last = now
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a request when it carries a valid API key in the `x-profile-key` header, or
+    at random with probability `sample_rate`. One request is profiled at a time.
+
+    The sampler reads the event loop thread, so time spent on other requests interleaved
+    with the profiled one is included. Only registered when profiling is enabled.
+    """
+
+    def __init__(self, app, store: ProfileStore, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 interval_ms: float = PROFILE_INTERVAL_MS):
+        if interval_ms <= 0:
+            # A zero wait turns the sampler into a busy loop holding the GIL
+            raise ValueError("PROFILE_INTERVAL_MS must be positive")
+        self.app = app
+        self.store = store
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000
+        self._busy = threading.Lock()
+
+    async def _requested(self, scope) -> bool:
+        key = dict(scope["headers"]).get(PROFILE_HEADER)
+        if key is not None:
+            try:
+                await validate_api_key(key.decode("latin-1"))
+                return True
+            except HTTPException:
+                return False
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not await self._requested(scope) or not self._busy.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(scope["method"], scope["path"])
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+            await send(message)
+
+        sampler = StackSampler(threading.get_ident(), profile, self.interval)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            sampler.stop()
+            profile.duration_ms = (time.perf_counter() - start) * 1000
+            self._busy.release()
+            self.store.add(profile)
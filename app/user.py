@@ -1,9 +1,34 @@
-from typing import List, Optional, Annotated
-from pydantic import BaseModel, Field, EmailStr, BeforeValidator
+from datetime import datetime
+from typing import List, Optional, Annotated, Literal, Any, Dict
+from pydantic import BaseModel, Field, EmailStr, BeforeValidator, field_validator
 
 PyObjectId = Annotated[str, BeforeValidator(str)]
 
 
+class GeoPoint(BaseModel):
+    type: Literal["Point"] = "Point"
+    coordinates: List[float] = Field(..., min_length=2, max_length=2, description="[longitude, latitude]")
+
+    @field_validator("coordinates")
+    @classmethod
+    def check_range(cls, coordinates: List[float]) -> List[float]:
+        longitude, latitude = coordinates
+        if not -180 <= longitude <= 180 or not -90 <= latitude <= 90:
+            raise ValueError("coordinates must be [longitude, latitude] within valid ranges")
+        return coordinates
+
+
+class SSOUserModel(BaseModel):
+    # Same fields as fastapi_sso's OpenID, without importing fastapi_sso (and httpx) at startup
+    id: Optional[str] = None
+    email: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    display_name: Optional[str] = None
+    picture: Optional[str] = None
+    provider: Optional[str] = None
+
+
 class UserModel(BaseModel):
     username: str = Field(..., min_length=3, max_length=30)
     first_name: str = Field(..., max_length=30)
@@ -27,6 +52,7 @@ class UserWithJWT(UserFullModel):
 
 class UserWithPwd(UserFullModel):
     password: str = Field(..., min_length=8)
+    geo: Optional[GeoPoint] = None
 
 
 class UserFriendsModel(BaseModel):
@@ -43,6 +69,7 @@ class UpdateUserModel(BaseModel):
     age: Optional[int] = Field(default=None, ge=13, le=150)
     gender: Optional[str] = None
     friends: Optional[List[str]] = None
+    geo: Optional[GeoPoint] = None
 
 
 class UpdateUsername(BaseModel):
@@ -51,3 +78,36 @@ class UpdateUsername(BaseModel):
 
 class UserCollection(BaseModel):
     users: List[UserModel]
+
+
+class UserMatchModel(UserModel):
+    id: Optional[PyObjectId] = Field(alias="_id", default=None)
+    score: float = Field(...)
+
+
+class UserMatchCollection(BaseModel):
+    matches: List[UserMatchModel]
+
+
+class NearbyUserModel(UserModel):
+    id: Optional[PyObjectId] = Field(alias="_id", default=None)
+    distance_km: float = Field(...)
+
+
+class NearbyUserCollection(BaseModel):
+    users: List[NearbyUserModel]
+    next_cursor: Optional[str] = None
+
+
+class UserChangeModel(BaseModel):
+    seq: int
+    op: Literal["create", "update", "delete"]
+    user_id: str
+    fields: Optional[Dict[str, Any]] = None
+    ts: datetime
+
+
+class UserChangeCollection(BaseModel):
+    changes: List[UserChangeModel]
+    next_since: int
+    has_more: bool
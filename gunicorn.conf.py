@@ -0,0 +1,17 @@
+import multiprocessing
+import os
+
+# gunicorn -c gunicorn.conf.py service:service
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# With preload the master imports the app once and forked workers share those modules copy-on-write,
+# so a new worker only runs the lifespan before it can serve. Clients (Mongo, Lambda, Google SSO) are
+# still created inside each worker, after the fork. Code changes then need a full restart, not a HUP.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() in ("1", "true", "yes")
+
+if preload_app:
+    # Imported lazily by the app on first use; importing them here lets the workers share them too
+    import boto3  # noqa: F401
+    import fastapi_sso.sso.google  # noqa: F401
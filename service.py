@@ -1,29 +1,39 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
 import random
+import secrets
 import string
 from contextlib import asynccontextmanager
 from datetime import timedelta, datetime
-from typing import Optional, Union, Annotated
+from functools import lru_cache
+from typing import Optional, Union, Annotated, List
 
-import boto3
 import certifi
 import uvicorn
 from bson import ObjectId
-from fastapi import FastAPI, Body, HTTPException, Security, Depends
+from fastapi import FastAPI, Body, HTTPException, Security, Depends, Query
 from fastapi.security import APIKeyCookie, OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi_sso.sso.base import OpenID
 from jose import jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
-from pymongo import MongoClient, ReturnDocument
+from pymongo import MongoClient, ReturnDocument, GEOSPHERE
 from random_username.generate import generate_username
 from starlette import status
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import PlainTextResponse
 
+from app.api_auth import validate_api_key
+from app.changes import ensure_change_indexes, record_change, history_truncated, read_changes, current_sequence, \
+    expire_changes, CHANGE_PURGE_INTERVAL_SECONDS
+from app.geo import GEO_FIELD, resolve_location, geo_point, decode_cursor, nearby_pipeline, next_cursor
 from app.google_auth import google_auth_app
-from app.user import UserModel, UpdateUserModel, UserCollection, UserWithPwd, UserFullModel, UserFriendsModel
+from app.matching import InterestIndex, MATCH_METHODS
+from app.profiling import PROFILING_ENABLED, ProfileStore, ProfilingMiddleware, ProfileSummary
+from app.user import UserModel, UpdateUserModel, UserCollection, UserWithPwd, UserFullModel, UserFriendsModel, \
+    UserMatchCollection, NearbyUserCollection, UserChangeCollection, SSOUserModel
 
 ATLAS_URI = os.environ.get('ATLAS_URI')
 SECRET_KEY = os.environ.get('SECRET_KEY')
@@ -31,26 +41,45 @@ AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY')
 AWS_SECRET_KEY = os.environ.get('AWS_SECRET_KEY')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+REFRESH_TOKEN_EXPIRE_DAYS = 30
+CHANGES_POLL_INTERVAL_SECONDS = 0.5
+MATCH_INDEX_REFRESH_SECONDS = float(os.environ.get('MATCH_INDEX_REFRESH_SECONDS', '2'))
+MATCH_INDEX_BATCH_SIZE = 1000
+# Every page sorts all matching users inside the radius, so keep searches local
+MAX_NEARBY_RADIUS_KM = 500
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 logger = logging.getLogger(__name__)
 mongodb_service = {}
+matching_service = {}
+profile_store = ProfileStore()
 
 TOPIC_ARN = os.environ.get('TOPIC_ARN')
-lambda_client = boto3.client(
-    'lambda',
-    aws_access_key_id=AWS_ACCESS_KEY,
-    aws_secret_access_key=AWS_SECRET_KEY,
-    region_name='us-east-1'
-)
+
+
+@lru_cache(maxsize=1)
+def get_lambda_client():
+    # boto3 is slow to import and the client is slow to build, so both wait for the first notification
+    import boto3
+
+    return boto3.client(
+        'lambda',
+        aws_access_key_id=AWS_ACCESS_KEY,
+        aws_secret_access_key=AWS_SECRET_KEY,
+        region_name='us-east-1'
+    )
 
 
 class SimpleResponseModel(BaseModel):
     message: str
 
 
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -85,21 +114,130 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     return encoded_jwt
 
 
-async def get_logged_user(cookie: str = Security(APIKeyCookie(name="token"))) -> OpenID:
+def hash_refresh_token(token: str) -> str:
+    # Refresh tokens are random and long, so a fast hash is enough to keep them unusable if the collection leaks
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_refresh_token(user: dict) -> str:
+    token = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    mongodb_service["refresh_tokens"].insert_one({
+        "token_hash": hash_refresh_token(token),
+        "user_id": str(user["_id"]),
+        "username": user["username"],
+        "email": user["email"],
+        "created_at": now,
+        "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    })
+    return token
+
+
+def issue_tokens(user: dict) -> dict:
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    data_for_token = {"username": user["username"],
+                      "email": user["email"]}
+    access_token = create_access_token(
+        data=data_for_token, expires_delta=access_token_expires
+    )
+    return {"access_token": access_token,
+            "token_type": "bearer",
+            "expires_in": int(access_token_expires.total_seconds()),
+            "refresh_token": create_refresh_token(user)}
+
+
+def record_user_change(op: str, user_id: str, fields: Optional[dict] = None) -> int:
+    return record_change(mongodb_service["changes"], mongodb_service["counters"], op, user_id, fields)
+
+
+async def get_logged_user(cookie: str = Security(APIKeyCookie(name="token"))) -> SSOUserModel:
     try:
         claims = jwt.decode(cookie, key=SECRET_KEY, algorithms=["HS256"])
-        return OpenID(**claims["pld"])
+        return SSOUserModel(**claims["pld"])
     except Exception as error:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials") from error
 
 
+def read_index_changes(since: int):
+    changes, has_more = read_changes(mongodb_service["changes"], since, MATCH_INDEX_BATCH_SIZE)
+    user_ids = {change["user_id"] for change in changes}
+    users = {
+        str(user["_id"]): user
+        for user in mongodb_service["collection"].find(
+            {"_id": {"$in": [ObjectId(user_id) for user_id in user_ids]}}, {"interests": 1, "location": 1}
+        )
+    }
+    return changes, user_ids, users, has_more
+
+
+async def sync_interest_index():
+    """
+    Build the match index without blocking startup, then follow the change feed so that
+    writes handled by other workers reach this worker's index too.
+    """
+    while True:
+        try:
+            since = await asyncio.to_thread(current_sequence, mongodb_service["counters"])
+            index = InterestIndex()
+            users = mongodb_service["collection"].find({}, {"interests": 1, "location": 1})
+            await asyncio.to_thread(index.rebuild, users)
+            # Writes made during the build went to the previous index; the feed replays them below
+            matching_service["index"] = index
+            matching_service["ready"] = True
+
+            while not await asyncio.to_thread(history_truncated, mongodb_service["counters"], since):
+                has_more = True
+                while has_more:
+                    changes, user_ids, users, has_more = await asyncio.to_thread(read_index_changes, since)
+                    # Mongo is read in a thread, the index is only changed on the event loop
+                    for user_id in user_ids:
+                        if user_id in users:
+                            index.upsert(user_id, users[user_id].get("interests"), users[user_id].get("location"))
+                        else:
+                            index.remove(user_id)
+                    if changes:
+                        since = changes[-1]["seq"]
+                await asyncio.sleep(MATCH_INDEX_REFRESH_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Interest index sync failed, rebuilding")
+            await asyncio.sleep(MATCH_INDEX_REFRESH_SECONDS)
+
+
+async def purge_user_changes():
+    while True:
+        try:
+            await asyncio.to_thread(expire_changes, mongodb_service["changes"], mongodb_service["counters"])
+        except Exception:
+            logger.exception("Expiring user changes failed")
+        await asyncio.sleep(CHANGE_PURGE_INTERVAL_SECONDS)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     mongodb_service["client"] = MongoClient(ATLAS_URI, tlsCAFile=certifi.where())
     mongodb_service["db"] = mongodb_service["client"]["TeamUp"]
     mongodb_service["collection"] = mongodb_service["db"]["Users"]
+    mongodb_service["refresh_tokens"] = mongodb_service["db"]["RefreshTokens"]
+    mongodb_service["changes"] = mongodb_service["db"]["UserChanges"]
+    mongodb_service["counters"] = mongodb_service["db"]["Counters"]
+    # Open the connection pool before the first request instead of during it
+    mongodb_service["client"].admin.command("ping")
+    mongodb_service["collection"].create_index([(GEO_FIELD, GEOSPHERE)])
+    mongodb_service["refresh_tokens"].create_index("token_hash", unique=True)
+    mongodb_service["refresh_tokens"].create_index("expires_at", expireAfterSeconds=0)
+    mongodb_service["refresh_tokens"].create_index("user_id")
+    ensure_change_indexes(mongodb_service["changes"])
+    matching_service["index"] = InterestIndex()
+    matching_service["ready"] = False
+    index_sync = asyncio.create_task(sync_interest_index())
+    changes_purge = asyncio.create_task(purge_user_changes())
     yield
+    index_sync.cancel()
+    changes_purge.cancel()
     mongodb_service.clear()
+    matching_service.clear()
 
 
 service = FastAPI(lifespan=lifespan)
@@ -111,6 +249,8 @@ service.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if PROFILING_ENABLED:
+    service.add_middleware(ProfilingMiddleware, store=profile_store)
 
 
 async def build_user_info(user):
@@ -162,21 +302,28 @@ async def create_user(user: UserWithPwd = Body(...)):
 
     user.password = get_password_hash(user.password)
 
-    new_user = mongodb_service["collection"].insert_one(
-        user.model_dump(by_alias=True, exclude={"id"})
-    )
+    user_document = user.model_dump(by_alias=True, exclude={"id", GEO_FIELD})
+    point = user.geo.model_dump() if user.geo is not None else resolve_location(user.location)
+    if point is not None:
+        user_document[GEO_FIELD] = point
+
+    new_user = mongodb_service["collection"].insert_one(user_document)
 
     created_user = mongodb_service["collection"].find_one(
         {"_id": new_user.inserted_id}
     )
+    matching_service["index"].upsert(str(created_user["_id"]), created_user["interests"], created_user["location"])
+    user_info = await build_user_info(created_user)
+    record_user_change("create", str(created_user["_id"]),
+                       {**user_info, "friends": created_user["friends"], GEO_FIELD: created_user.get(GEO_FIELD)})
 
     lambda_payload = {
         "action": "create",
         "subject": f"User {created_user['_id']} created successfully",
-        "user_info": await build_user_info(created_user)
+        "user_info": user_info
     }
 
-    lambda_client.invoke(
+    get_lambda_client().invoke(
         FunctionName='userSNSnotifications',
         InvocationType='Event',
         Payload=json.dumps(lambda_payload),
@@ -202,6 +349,76 @@ async def list_all_users(interest: Optional[str] = None, location: Optional[str]
     return UserCollection(users=items)
 
 
+@service.get(
+    "/users/nearby",
+    response_description="List users near a point or a known location, closest first, with cursor pagination",
+    response_model=NearbyUserCollection,
+    response_model_by_alias=False,
+)
+async def list_nearby_users(longitude: Optional[float] = Query(None, ge=-180, le=180),
+                            latitude: Optional[float] = Query(None, ge=-90, le=90),
+                            location: Optional[str] = None,
+                            radius_km: float = Query(25, gt=0, le=MAX_NEARBY_RADIUS_KM),
+                            interest: Optional[str] = None,
+                            limit: int = Query(5, ge=1, le=100),
+                            cursor: Optional[str] = None):
+    if longitude is not None and latitude is not None:
+        point = geo_point(longitude, latitude)
+    elif (point := resolve_location(location)) is None:
+        raise HTTPException(status_code=400,
+                            detail="Provide longitude and latitude, or a location listed in the gazetteer")
+
+    try:
+        page_cursor = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    query = {}
+    if interest:
+        query["interests"] = {"$in": [interest]}
+
+    users = list(mongodb_service["collection"].aggregate(
+        nearby_pipeline(point, radius_km * 1000, limit, query, page_cursor)
+    ))
+    return NearbyUserCollection(
+        users=[{**user, "distance_km": user["distance"] / 1000} for user in users],
+        next_cursor=next_cursor(users, limit),
+    )
+
+
+@service.get(
+    "/users/changes",
+    response_description="List user changes after a sequence number, optionally waiting for new ones",
+    response_model=UserChangeCollection,
+)
+async def list_user_changes(since: Optional[int] = Query(None, ge=0),
+                            limit: int = Query(100, ge=1, le=1000),
+                            wait: float = Query(0, ge=0, le=30)):
+    # Every Mongo read runs in a thread so that waiting consumers do not stall the event loop
+    head = await asyncio.to_thread(current_sequence, mongodb_service["counters"])
+    if since is None:
+        # A new consumer saves the head before listing users, then follows changes from there
+        return UserChangeCollection(changes=[], next_since=head, has_more=False)
+
+    if await asyncio.to_thread(history_truncated, mongodb_service["counters"], since):
+        raise HTTPException(status_code=410,
+                            detail={"message": f"Changes after {since} have expired, "
+                                               f"save next_since and sync again from GET /users/",
+                                    "next_since": head})
+
+    deadline = asyncio.get_running_loop().time() + wait
+    while not (result := await asyncio.to_thread(read_changes, mongodb_service["changes"], since, limit))[0] \
+            and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(CHANGES_POLL_INTERVAL_SECONDS)
+
+    changes, has_more = result
+    return UserChangeCollection(
+        changes=changes,
+        next_since=changes[-1]["seq"] if changes else since,
+        has_more=has_more,
+    )
+
+
 @service.get(
     "/users/id/{user_id}",
     response_description="Find a user by id",
@@ -267,14 +484,24 @@ async def update_user_profile(user_id: str, user: UpdateUserModel = Body(...)):
     }
 
     if len(user) >= 1:
+        update = {"$set": user}
+        if "location" in user and GEO_FIELD not in user:
+            # Keep coordinates in sync with a new location, and drop stale ones it cannot be resolved
+            if (point := resolve_location(user["location"])) is not None:
+                user[GEO_FIELD] = point
+            else:
+                update["$unset"] = {GEO_FIELD: ""}
+
         update_result = mongodb_service["collection"].find_one_and_update(
             {"_id": ObjectId(user_id)},
-            {"$set": user},
+            update,
             return_document=ReturnDocument.AFTER,
         )
 
         changes = {k: {"old": current_user.get(k), 'new': user[k]} for k in user}
         if update_result is not None:
+            matching_service["index"].upsert(user_id, update_result["interests"], update_result["location"])
+            record_user_change("update", user_id, {**user, **{k: None for k in update.get("$unset", {})}})
             message = {'details': changes}
             lambda_payload = {
                 "action": "update",
@@ -282,7 +509,7 @@ async def update_user_profile(user_id: str, user: UpdateUserModel = Body(...)):
                 "change": message
             }
 
-            lambda_client.invoke(
+            get_lambda_client().invoke(
                 FunctionName='userSNSnotifications',
                 InvocationType='Event',
                 Payload=json.dumps(lambda_payload),
@@ -313,13 +540,17 @@ async def delete_user(user_id: str):
     if delete_result.deleted_count == 0:
         raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
 
+    matching_service["index"].remove(user_id)
+    mongodb_service["refresh_tokens"].delete_many({"user_id": user_id})
+    record_user_change("delete", user_id)
+
     lambda_payload = {
         "action": "delete",
         "subject": f"User {user_id} has been deleted",
         "user_info": await build_user_info(user)
     }
 
-    lambda_client.invoke(
+    get_lambda_client().invoke(
         FunctionName='userSNSnotifications',
         InvocationType='Event',
         Payload=json.dumps(lambda_payload),
@@ -345,16 +576,70 @@ async def find_user_friends_by_id(user_id: str):
     return user
 
 
+@service.get(
+    "/users/{user_id}/matches",
+    response_description="Rank other users by shared interests, optionally within the same location",
+    response_model=UserMatchCollection,
+    response_model_by_alias=False,
+)
+async def find_user_matches(user_id: str, method: str = "jaccard", same_location: bool = False,
+                            limit: int = Query(10, ge=1, le=100)):
+    if method not in MATCH_METHODS:
+        raise HTTPException(status_code=400, detail=f"Match method must be one of {', '.join(MATCH_METHODS)}")
+
+    if not matching_service["ready"]:
+        raise HTTPException(status_code=503, detail="Match index is still loading, retry shortly")
+
+    interest_index = matching_service["index"]
+    if user_id not in interest_index:
+        # Created on another worker and not synced from the change feed yet
+        user = mongodb_service["collection"].find_one({"_id": ObjectId(user_id)}, {"interests": 1, "location": 1})
+        if user is None:
+            raise HTTPException(status_code=404, detail=f"User ID of {user_id} not found")
+        interest_index.upsert(user_id, user.get("interests"), user.get("location"))
+
+    ranked = interest_index.top_matches(user_id, k=limit, method=method, same_location=same_location)
+    users = {
+        str(user["_id"]): user
+        for user in mongodb_service["collection"].find({"_id": {"$in": [ObjectId(i) for i, _ in ranked]}})
+    }
+    matches = [{**users[i], "score": score} for i, score in ranked if i in users]
+    return UserMatchCollection(matches=matches)
+
+
 @service.post("/token")
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
     user = authenticate_user_by_username(form_data.username, form_data.password)
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    data_for_token = {"username": user["username"],
-                      "email": user["email"]}
-    access_token = create_access_token(
-        data=data_for_token, expires_delta=access_token_expires
+    return issue_tokens(user)
+
+
+@service.post("/token/refresh")
+async def refresh_access_token(request: RefreshTokenRequest = Body(...)):
+    # Deleting the stored token on use rotates it: each refresh token works exactly once
+    stored_token = mongodb_service["refresh_tokens"].find_one_and_delete(
+        {"token_hash": hash_refresh_token(request.refresh_token), "expires_at": {"$gt": datetime.utcnow()}}
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+
+    if stored_token is None:
+        raise HTTPException(status_code=401,
+                            detail="Refresh token is invalid, expired or already used",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+    return issue_tokens({"_id": stored_token["user_id"],
+                         "username": stored_token["username"],
+                         "email": stored_token["email"]})
+
+
+@service.delete(
+    "/users/{user_id}/tokens",
+    response_description="Revoke all refresh tokens of a user",
+    response_model=SimpleResponseModel,
+    response_model_by_alias=False,
+    dependencies=[Depends(validate_api_key)],
+)
+async def revoke_refresh_tokens(user_id: str):
+    delete_result = mongodb_service["refresh_tokens"].delete_many({"user_id": user_id})
+    return {"message": f"Revoked {delete_result.deleted_count} refresh tokens"}
 
 
 @service.get(
@@ -362,7 +647,7 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
     response_description="SSO login user",
     response_model_by_alias=False
 )
-async def google_sso_access_token(user: OpenID = Depends(get_logged_user)):
+async def google_sso_access_token(user: SSOUserModel = Depends(get_logged_user)):
     try:
         # Return the user profile if the user already exists
         user_result = await find_user_by_email(user.email)
@@ -394,13 +679,31 @@ async def google_sso_access_token(user: OpenID = Depends(get_logged_user)):
         user_result = await create_user(UserWithPwd(**new_user))
 
     # Create a JWT token for normal TeamUP login
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    data_for_token = {"username": user_result["username"],
-                      "email": user_result["email"]}
-    access_token = create_access_token(
-        data=data_for_token, expires_delta=access_token_expires
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return issue_tokens(user_result)
+
+
+@service.get(
+    "/admin/profiles",
+    response_description="List the most recent request profiles, newest first",
+    response_model=List[ProfileSummary],
+    dependencies=[Depends(validate_api_key)],
+)
+async def list_profiles():
+    return [profile.summary() for profile in profile_store.list()]
+
+
+@service.get(
+    "/admin/profiles/{profile_id}",
+    response_description="Folded stacks of a request profile, for flamegraph.pl or speedscope",
+    response_class=PlainTextResponse,
+    dependencies=[Depends(validate_api_key)],
+)
+async def get_profile(profile_id: str):
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+
+    return profile.collapsed()
 
 
 @service.get(
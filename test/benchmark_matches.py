@@ -0,0 +1,95 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+import certifi
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.matching import InterestIndex  # noqa: E402
+
+INTERESTS = ["Music", "Travel", "Food", "Gaming", "Arts & Creativity", "Health & Fitness",
+             "Technology & Programming", "Movies & Entertainment"] + [f"Interest {i}" for i in range(32)]
+LOCATIONS = ["New York, NY", "Philadelphia, PA", "Chicago, IL", "Houston, TX", "Phoenix, AZ",
+             "San Antonio, TX", "Los Angeles, CA", "San Diego, CA", "Dallas, TX", "San Jose, CA"]
+
+
+def generate_users(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        {
+            "_id": f"{i:024x}",
+            "interests": rng.sample(INTERESTS, rng.randint(1, 5)),
+            "location": rng.choice(LOCATIONS),
+        }
+        for i in range(count)
+    ]
+
+
+def naive_match_pipeline(user: dict, k: int, same_location: bool):
+    match = {"_id": {"$ne": user["_id"]}, "interests": {"$in": user["interests"]}}
+    if same_location:
+        match["location"] = user["location"]
+    return [
+        {"$match": match},
+        {"$project": {"score": {"$divide": [
+            {"$size": {"$setIntersection": ["$interests", user["interests"]]}},
+            {"$size": {"$setUnion": ["$interests", user["interests"]]}},
+        ]}}},
+        {"$sort": {"score": -1}},
+        {"$limit": k},
+    ]
+
+
+def timed(fn, repeat: int):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the interest index with a Mongo aggregation")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--mongo", action="store_true",
+                        help="Also run the aggregation against a scratch collection in ATLAS_URI")
+    args = parser.parse_args()
+
+    users = generate_users(args.users)
+    index = InterestIndex()
+    start = time.perf_counter()
+    index.rebuild(users)
+    print(f"index build ({args.users} users): {time.perf_counter() - start:.2f} s")
+
+    for method in ("jaccard", "weighted"):
+        for same_location in (False, True):
+            ms = timed(lambda i: index.top_matches(users[i]["_id"], args.k, method, same_location), args.queries)
+            print(f"index {method:<8} same_location={same_location!s:<5}: {ms:.2f} ms/query")
+
+    if not args.mongo:
+        return
+
+    client = MongoClient(os.environ.get("ATLAS_URI"), tlsCAFile=certifi.where())
+    collection = client["TeamUp"]["UsersMatchBenchmark"]
+    collection.drop()
+    try:
+        for offset in range(0, len(users), 10_000):
+            collection.insert_many(users[offset:offset + 10_000], ordered=False)
+        collection.create_index("interests")
+        collection.create_index("location")
+        for same_location in (False, True):
+            ms = timed(lambda i: list(collection.aggregate(naive_match_pipeline(users[i], args.k, same_location))),
+                       min(args.queries, 10))
+            print(f"mongo    jaccard same_location={same_location!s:<5}: {ms:.2f} ms/query")
+    finally:
+        collection.drop()
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,17 @@
+import os
+import re
+import sys
 import unittest
+from unittest import mock
+
 import requests
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.profiling import ProfileStore, ProfilingMiddleware  # noqa: E402
 
 
 class UserTest(unittest.TestCase):
@@ -129,6 +141,162 @@ class UserTest(unittest.TestCase):
         deleted = requests.delete(self.url + "users/" + user_id, headers=self.headers)
         self.assertEqual(deleted.status_code, 200)
 
+    def test_matches(self):
+        response = requests.post(self.url + "users", json=self.user, headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+
+        response = requests.get(self.url + "users/name/" + self.user["username"], headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        user_id = response.json()['id']
+
+        response = requests.get(self.url + "users/" + user_id + "/matches",
+                                params={"same_location": True, "limit": 3}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        matches = response.json()["matches"]
+        self.assertLessEqual(len(matches), 3)
+        self.assertNotIn(user_id, [match["id"] for match in matches])
+        self.assertTrue(all(match["location"] == self.user["location"] for match in matches))
+        self.assertEqual([match["score"] for match in matches],
+                         sorted([match["score"] for match in matches], reverse=True))
+
+        response = requests.get(self.url + "users/" + user_id + "/matches",
+                                params={"method": "cosine"}, headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+        response = requests.get(self.url + "users/" + user_id + "/matches",
+                                params={"limit": 1000}, headers=self.headers)
+        self.assertEqual(response.status_code, 422)
+
+        deleted = requests.delete(self.url + "users/" + user_id, headers=self.headers)
+        self.assertEqual(deleted.status_code, 200)
+
+        response = requests.get(self.url + "users/" + user_id + "/matches", headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_nearby_users(self):
+        response = requests.post(self.url + "users", json=self.user, headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+
+        params = {"location": "Brooklyn, NY", "radius_km": 20, "interest": "Travel", "limit": 2}
+        usernames, distances = [], []
+        while True:
+            response = requests.get(self.url + "users/nearby", params=params, headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page["users"]), 2)
+            usernames += [user["username"] for user in page["users"]]
+            distances += [user["distance_km"] for user in page["users"]]
+            if page["next_cursor"] is None:
+                break
+            params["cursor"] = page["next_cursor"]
+
+        self.assertIn(self.user["username"], usernames)
+        self.assertEqual(len(usernames), len(set(usernames)))
+        self.assertEqual(distances, sorted(distances))
+        self.assertTrue(all(distance <= 20 for distance in distances))
+
+        response = requests.get(self.url + "users/nearby", params={"location": "Atlantis"}, headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+        response = requests.get(self.url + "users/name/" + self.user["username"], headers=self.headers)
+        user_id = response.json()['id']
+        deleted = requests.delete(self.url + "users/" + user_id, headers=self.headers)
+        self.assertEqual(deleted.status_code, 200)
+
+    def test_refresh_token(self):
+        response = requests.post(self.url + "users", json=self.user, headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+
+        response = requests.post(self.url + "token",
+                                 data={'username': 'test', 'password': '12345678'})
+        self.assertEqual(response.status_code, 200)
+        refresh_token = response.json()["refresh_token"]
+
+        response = requests.post(self.url + "token/refresh", json={"refresh_token": refresh_token},
+                                 headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("access_token", response.json())
+        rotated_token = response.json()["refresh_token"]
+        self.assertNotEqual(rotated_token, refresh_token)
+
+        response = requests.post(self.url + "token/refresh", json={"refresh_token": refresh_token},
+                                 headers=self.headers)
+        self.assertEqual(response.status_code, 401)
+
+        response = requests.get(self.url + "users/name/" + self.user["username"], headers=self.headers)
+        user_id = response.json()['id']
+
+        response = requests.delete(self.url + "users/" + user_id + "/tokens", headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+        response = requests.delete(self.url + "users/" + user_id + "/tokens",
+                                   headers={**self.headers, "api-key": "incorrect-key"})
+        self.assertEqual(response.status_code, 401)
+
+        response = requests.post(self.url + "token/refresh", json={"refresh_token": rotated_token},
+                                 headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        rotated_token = response.json()["refresh_token"]
+
+        response = requests.delete(self.url + "users/" + user_id + "/tokens",
+                                   headers={**self.headers, "api-key": os.environ.get("API_KEY")})
+        self.assertEqual(response.status_code, 200)
+
+        response = requests.post(self.url + "token/refresh", json={"refresh_token": rotated_token},
+                                 headers=self.headers)
+        self.assertEqual(response.status_code, 401)
+
+        deleted = requests.delete(self.url + "users/" + user_id, headers=self.headers)
+        self.assertEqual(deleted.status_code, 200)
+
+    def test_user_changes(self):
+        response = requests.get(self.url + "users/changes", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["changes"], [])
+        head = response.json()["next_since"]
+
+        response = requests.post(self.url + "users", json=self.user, headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+
+        response = requests.get(self.url + "users/name/" + self.user["username"], headers=self.headers)
+        user_id = response.json()['id']
+
+        response = requests.put(self.url + "users/" + user_id + "/profile", json={"age": 24}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        deleted = requests.delete(self.url + "users/" + user_id, headers=self.headers)
+        self.assertEqual(deleted.status_code, 200)
+
+        since, changes = head, []
+        while True:
+            response = requests.get(self.url + "users/changes", params={"since": since, "limit": 100},
+                                    headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            changes += page["changes"]
+            since = page["next_since"]
+            if not page["has_more"]:
+                break
+
+        user_changes = [(change["op"], change["fields"]) for change in changes if change["user_id"] == user_id]
+        self.assertEqual([op for op, _ in user_changes], ["create", "update", "delete"])
+        self.assertEqual(user_changes[0][1]["username"], self.user["username"])
+        self.assertIn("geo", user_changes[0][1])
+        self.assertEqual(user_changes[1][1], {"age": 24})
+        self.assertIsNone(user_changes[2][1])
+
+        response = requests.get(self.url + "users/changes", params={"since": since, "wait": 1}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["next_since"], since)
+
+    def test_profiles_require_api_key(self):
+        response = requests.get(self.url + "admin/profiles", headers={"api-key": "incorrect-key"})
+        self.assertEqual(response.status_code, 401)
+
+        response = requests.get(self.url + "admin/profiles/unknown", headers={"api-key": "incorrect-key"})
+        self.assertEqual(response.status_code, 401)
+
     def test_login(self):
         response = requests.post(self.url + "users", json=self.user, headers=self.headers)
         self.assertEqual(response.status_code, 201)
@@ -150,5 +318,50 @@ class UserTest(unittest.TestCase):
         self.assertEqual(deleted.status_code, 200)
 
 
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("app.api_auth.API_KEY", "test-key")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.store = ProfileStore(size=2)
+        app = FastAPI()
+        app.add_middleware(ProfilingMiddleware, store=self.store, sample_rate=0, interval_ms=1)
+        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+        @app.get("/hash")
+        async def hash_password():
+            return {"hash": pwd_context.hash("12345678")}
+
+        self.client = TestClient(app)
+
+    def test_profile_with_valid_key(self):
+        response = self.client.get("/hash", headers={"x-profile-key": "test-key"})
+        self.assertEqual(response.status_code, 200)
+
+        profiles = self.store.list()
+        self.assertEqual(len(profiles), 1)
+        summary = profiles[0].summary()
+        self.assertEqual((summary.method, summary.path, summary.status_code), ("GET", "/hash", 200))
+        self.assertGreater(summary.samples, 0)
+        self.assertEqual(max(summary.time_ms, key=summary.time_ms.get), "bcrypt")
+
+        lines = profiles[0].collapsed().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertRegex(line, re.compile(r"^\S+ \d+$"))
+
+    def test_no_profile_without_valid_key(self):
+        self.client.get("/hash")
+        self.client.get("/hash", headers={"x-profile-key": "incorrect-key"})
+        self.assertEqual(self.store.list(), [])
+
+    def test_store_is_bounded(self):
+        for _ in range(3):
+            self.client.get("/hash", headers={"x-profile-key": "test-key"})
+        self.assertEqual(len(self.store.list()), 2)
+
+
 if __name__ == '__main__':
     unittest.main()